@@ -5,13 +5,18 @@
 GPT-4o Visionで自動チェックします。
 """
 
+import hashlib
+import html
 import os
+import string
 import sys
-import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
 from typing import List, Dict, Any
 
+import orjson
 import streamlit as st
 from dotenv import load_dotenv
 
@@ -44,6 +49,29 @@ def get_api_key() -> str:
     return ""
 
 
+# 同時に処理するファイル数の上限
+# （各ファイルの内部でもページ並列のAPI呼び出しが走るため控えめに）
+MAX_PARALLEL_FILES = 4
+
+
+@st.cache_resource(show_spinner=False)
+def get_processor() -> FileProcessor:
+    """FileProcessorを生成（Streamlitの再実行間で使い回し）"""
+    return FileProcessor()
+
+
+@st.cache_resource(show_spinner=False)
+def get_checker(api_key_hash: str, _api_key: str) -> OpenAICreativeChecker:
+    """OpenAICreativeCheckerを生成（再実行間で使い回し）
+
+    毎回生成するとプロンプトの再読込とHTTPクライアントの再接続
+    （TLSハンドシェイク）が発生するためキャッシュします。
+    キャッシュキーには生のAPIキーではなくハッシュを使い、
+    キー本体（_api_key）はStreamlitのハッシュ対象から除外します。
+    """
+    return OpenAICreativeChecker(api_key=_api_key)
+
+
 # ページ設定
 st.set_page_config(
     page_title="オリコン クリエイティブチェッカー",
@@ -97,6 +125,18 @@ st.markdown("""
         border-radius: 5px;
         margin: 0.25rem 0;
     }
+    .detected-grid {
+        display: grid;
+        grid-template-columns: 1fr 1fr;
+        gap: 0 1rem;
+    }
+    .notes-box {
+        background-color: #d1ecf1;
+        color: #0c5460;
+        padding: 1rem;
+        border-radius: 5px;
+        margin: 0.5rem 0;
+    }
     .header-title {
         color: #1e3a5f;
         font-size: 2.5rem;
@@ -154,74 +194,86 @@ def get_severity_class(severity: str) -> str:
         return "issue-info"
 
 
-def display_result(result: Dict[str, Any]):
-    """判定結果を表示"""
+# 結果カードのHTMLテンプレート（再実行のたびに組み立てるため事前コンパイル）
+_CARD_HEADER_TMPL = string.Template(
+    '<div class="result-card $color_class">'
+    '<h3>$emoji $file_name</h3>'
+    '<p><strong>企業名:</strong> $company_name</p>'
+    '<p><strong>判定結果:</strong> <span style="font-size: 1.2rem; font-weight: bold;">$judgment</span></p>'
+    '</div>'
+)
+_ISSUE_TMPL = string.Template(
+    '<p class="$severity_class"><strong>$severity_label [$category]</strong>: $description</p>'
+)
+_ELEMENT_TMPL = string.Template(
+    '<div class="detected-element"><strong>$label:</strong> $value</div>'
+)
+
+_SEVERITY_LABELS = {
+    "critical": "🔴 重大",
+    "warning": "🟡 警告",
+    "info": "🔵 情報"
+}
+
+
+def build_result_html(result: Dict[str, Any]) -> str:
+    """判定結果1件分のカードHTMLを組み立てる
+
+    Streamlitのmarkdown呼び出しは1回ごとにフロントエンドとの往復が
+    発生するため、カード全体を1つのHTML文字列にまとめます。
+    """
     judgment = result.get("judgment", "不明")
-    color_class = get_judgment_color(judgment)
-    emoji = get_judgment_emoji(judgment)
-
-    with st.container():
-        st.markdown(f"""
-        <div class="result-card {color_class}">
-            <h3>{emoji} {result.get('file_name', '不明')}</h3>
-            <p><strong>企業名:</strong> {result.get('company_name', '不明')}</p>
-            <p><strong>判定結果:</strong> <span style="font-size: 1.2rem; font-weight: bold;">{judgment}</span></p>
-        </div>
-        """, unsafe_allow_html=True)
-
-        # 問題点の表示
-        issues = result.get("issues", [])
-        if issues:
-            st.markdown("#### 🔍 検出された問題")
-            for issue in issues:
-                severity = issue.get("severity", "info")
-                category = issue.get("category", "その他")
-                description = issue.get("description", "")
-                severity_class = get_severity_class(severity)
-
-                severity_label = {
-                    "critical": "🔴 重大",
-                    "warning": "🟡 警告",
-                    "info": "🔵 情報"
-                }.get(severity, "ℹ️")
-
-                st.markdown(f"""
-                <p class="{severity_class}">
-                    <strong>{severity_label} [{category}]</strong>: {description}
-                </p>
-                """, unsafe_allow_html=True)
-
-        # 検出された要素の表示
-        detected = result.get("detected_elements", {})
-        if detected:
-            st.markdown("#### 📋 検出された要素")
-            col1, col2 = st.columns(2)
-
-            with col1:
-                year = detected.get("year")
-                st.markdown(f'<div class="detected-element"><strong>年度:</strong> {year if year else "❌ 未検出"}</div>', unsafe_allow_html=True)
-
-                issuer = detected.get("issuer")
-                st.markdown(f'<div class="detected-element"><strong>発行元:</strong> {issuer if issuer else "❌ 未検出"}</div>', unsafe_allow_html=True)
-
-            with col2:
-                ranking = detected.get("ranking_name")
-                st.markdown(f'<div class="detected-element"><strong>ランキング名:</strong> {ranking if ranking else "❌ 未検出"}</div>', unsafe_allow_html=True)
-
-                position = detected.get("position")
-                st.markdown(f'<div class="detected-element"><strong>順位:</strong> {position if position else "❌ 未検出"}</div>', unsafe_allow_html=True)
-
-            trademark = detected.get("trademark_symbol", False)
-            trademark_status = "✅ あり" if trademark else "❌ なし"
-            st.markdown(f'<div class="detected-element"><strong>(R)マーク:</strong> {trademark_status}</div>', unsafe_allow_html=True)
-
-        # 備考の表示
-        notes = result.get("notes")
-        if notes:
-            st.markdown("#### 📝 備考・確認事項")
-            st.info(notes)
 
-        st.markdown("---")
+    parts = [_CARD_HEADER_TMPL.substitute(
+        color_class=get_judgment_color(judgment),
+        emoji=get_judgment_emoji(judgment),
+        file_name=html.escape(str(result.get("file_name", "不明"))),
+        company_name=html.escape(str(result.get("company_name", "不明"))),
+        judgment=html.escape(str(judgment)),
+    )]
+
+    # 問題点
+    issues = result.get("issues", [])
+    if issues:
+        parts.append("<h4>🔍 検出された問題</h4>")
+        for issue in issues:
+            severity = issue.get("severity", "info")
+            parts.append(_ISSUE_TMPL.substitute(
+                severity_class=get_severity_class(severity),
+                severity_label=_SEVERITY_LABELS.get(severity, "ℹ️"),
+                category=html.escape(str(issue.get("category", "その他"))),
+                description=html.escape(str(issue.get("description", ""))),
+            ))
+
+    # 検出された要素
+    detected = result.get("detected_elements", {})
+    if detected:
+        parts.append('<h4>📋 検出された要素</h4><div class="detected-grid">')
+        for label, key in (("年度", "year"), ("ランキング名", "ranking_name"),
+                           ("発行元", "issuer"), ("順位", "position")):
+            value = detected.get(key)
+            parts.append(_ELEMENT_TMPL.substitute(
+                label=label,
+                value=html.escape(str(value)) if value else "❌ 未検出",
+            ))
+        parts.append("</div>")
+
+        trademark_status = "✅ あり" if detected.get("trademark_symbol", False) else "❌ なし"
+        parts.append(_ELEMENT_TMPL.substitute(label="(R)マーク", value=trademark_status))
+
+    # 備考
+    notes = result.get("notes")
+    if notes:
+        parts.append("<h4>📝 備考・確認事項</h4>")
+        parts.append(f'<div class="notes-box">{html.escape(str(notes))}</div>')
+
+    parts.append("<hr>")
+    return "".join(parts)
+
+
+def display_result(result: Dict[str, Any]):
+    """判定結果を表示（カード全体を1回のmarkdown呼び出しで描画）"""
+    st.markdown(build_result_html(result), unsafe_allow_html=True)
 
 
 def main():
@@ -290,9 +342,9 @@ def main():
         if uploaded_files:
             st.success(f"{len(uploaded_files)} 件のファイルがアップロードされました")
 
-            # ファイルリスト表示
+            # ファイルリスト表示（size属性を使い、内容のコピーを作らない）
             for uploaded_file in uploaded_files:
-                file_size = len(uploaded_file.getvalue()) / 1024  # KB
+                file_size = uploaded_file.size / 1024  # KB
                 st.text(f"📄 {uploaded_file.name} ({file_size:.1f} KB)")
 
         # チェック実行ボタン
@@ -304,9 +356,10 @@ def main():
                 st.session_state.results = []
 
                 try:
-                    # プロセッサとチェッカーを初期化
-                    processor = FileProcessor()
-                    checker = OpenAICreativeChecker(api_key=api_key)
+                    # プロセッサとチェッカーを取得（キャッシュ済みなら再利用）
+                    processor = get_processor()
+                    api_key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+                    checker = get_checker(api_key_hash, api_key)
 
                     # プログレスバー
                     progress_bar = st.progress(0)
@@ -314,34 +367,46 @@ def main():
 
                     total_files = len(uploaded_files)
 
-                    for i, uploaded_file in enumerate(uploaded_files):
-                        status_text.text(f"処理中: {uploaded_file.name} ({i + 1}/{total_files})")
-
-                        try:
-                            # ファイルを処理
-                            uploaded_file.seek(0)  # ファイルポインタをリセット
-                            images = processor.process_uploaded_file(uploaded_file)
-
-                            # 画像をチェック
-                            results = checker.check_multiple_images(images, uploaded_file.name)
-                            st.session_state.results.extend(results)
-
-                        except Exception as e:
-                            st.session_state.results.append({
-                                "file_name": uploaded_file.name,
-                                "company_name": "不明",
-                                "judgment": "エラー",
-                                "issues": [{
-                                    "severity": "critical",
-                                    "category": "処理エラー",
-                                    "description": str(e)
-                                }],
-                                "detected_elements": {},
-                                "notes": "ファイル処理中にエラーが発生しました"
-                            })
-
-                        # プログレス更新
-                        progress_bar.progress((i + 1) / total_files)
+                    def process_one(uploaded_file):
+                        """1ファイル分の変換＋判定（ワーカースレッドで実行）"""
+                        images = processor.process_bytes(
+                            uploaded_file.getvalue(), uploaded_file.name
+                        )
+                        return checker.check_multiple_images(images, uploaded_file.name)
+
+                    # ファイル単位で並列処理し、終わったものからUIに反映する
+                    # （遅いファイルが速いファイルの結果表示を塞がない）
+                    max_workers = min(total_files, MAX_PARALLEL_FILES)
+                    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                        futures = {
+                            executor.submit(process_one, uploaded_file): uploaded_file
+                            for uploaded_file in uploaded_files
+                        }
+
+                        done_count = 0
+                        for future in as_completed(futures):
+                            uploaded_file = futures[future]
+
+                            try:
+                                st.session_state.results.extend(future.result())
+                            except Exception as e:
+                                st.session_state.results.append({
+                                    "file_name": uploaded_file.name,
+                                    "company_name": "不明",
+                                    "judgment": "エラー",
+                                    "issues": [{
+                                        "severity": "critical",
+                                        "category": "処理エラー",
+                                        "description": str(e)
+                                    }],
+                                    "detected_elements": {},
+                                    "notes": "ファイル処理中にエラーが発生しました"
+                                })
+
+                            # プログレス更新（完了したファイルから順次）
+                            done_count += 1
+                            status_text.text(f"処理中: {done_count}/{total_files} 件完了（直近: {uploaded_file.name}）")
+                            progress_bar.progress(done_count / total_files)
 
                     status_text.text("✅ チェック完了！")
                     st.session_state.processing = False
@@ -354,11 +419,12 @@ def main():
         st.header("📊 判定結果")
 
         if st.session_state.results:
-            # サマリー
+            # サマリー（結果リストを1パスで集計）
             total = len(st.session_state.results)
-            ok_count = sum(1 for r in st.session_state.results if r.get("judgment") == "問題なし")
-            ng_count = sum(1 for r in st.session_state.results if r.get("judgment") == "問題あり")
-            warn_count = sum(1 for r in st.session_state.results if r.get("judgment") == "要確認")
+            counts = Counter(r.get("judgment") for r in st.session_state.results)
+            ok_count = counts["問題なし"]
+            ng_count = counts["問題あり"]
+            warn_count = counts["要確認"]
 
             col_a, col_b, col_c, col_d = st.columns(4)
             col_a.metric("合計", total)
@@ -375,7 +441,10 @@ def main():
             # JSON エクスポート
             st.download_button(
                 label="📥 結果をJSONでダウンロード",
-                data=json.dumps(st.session_state.results, ensure_ascii=False, indent=2),
+                data=orjson.dumps(
+                    st.session_state.results,
+                    option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+                ).decode(),
                 file_name=f"creative_check_result_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
                 mime="application/json"
             )
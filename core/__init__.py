@@ -2,5 +2,6 @@
 
 from .file_processor import FileProcessor
 from .openai_checker import OpenAICreativeChecker
+from .prefilter import LocalPrefilter
 
-__all__ = ["FileProcessor", "OpenAICreativeChecker"]
+__all__ = ["FileProcessor", "OpenAICreativeChecker", "LocalPrefilter"]
@@ -7,17 +7,132 @@ OpenAI Vision APIに送信可能な形式に変換します。
 
 import base64
 import io
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from types import MappingProxyType
 from typing import List, Tuple, Optional
 from PIL import Image
 
-# PyMuPDF (PDFの画像変換用)
+# pypdfium2 (PDFレンダリングの第一候補・PDFium製で高速)
+try:
+    import pypdfium2 as pdfium
+    PYPDFIUM2_AVAILABLE = True
+except ImportError:
+    PYPDFIUM2_AVAILABLE = False
+
+# PyMuPDF (pypdfium2が無い場合のフォールバック)
 try:
     import fitz  # PyMuPDF
     PYMUPDF_AVAILABLE = True
 except ImportError:
     PYMUPDF_AVAILABLE = False
-    print("Warning: PyMuPDF not installed. PDF processing will be disabled.")
+
+PDF_RENDERING_AVAILABLE = PYPDFIUM2_AVAILABLE or PYMUPDF_AVAILABLE
+if not PDF_RENDERING_AVAILABLE:
+    print("Warning: neither pypdfium2 nor PyMuPDF is installed. PDF processing will be disabled.")
+
+# PDFiumはスレッドセーフではない（pypdfium2もロックを持たない）ため、
+# 同一プロセス内のPDFium/fitz呼び出しはこのロックで直列化する。
+# 競合するとPythonの例外ではなくプロセスごとセグフォルトで落ちる。
+# プロセスプールのワーカー内ではロックはプロセスローカルなので無競合。
+_PDF_RENDER_LOCK = threading.Lock()
+
+# レンダリング用プロセスプール（プロセス全体で1つを使い回す）
+_render_pool: Optional[ProcessPoolExecutor] = None
+_render_pool_lock = threading.Lock()
+
+
+def _get_render_pool() -> ProcessPoolExecutor:
+    """共有のレンダリング用プロセスプールを取得（初回呼び出し時に生成）
+
+    spawn起動を明示する。Streamlitのワーカースレッドから呼ばれるため、
+    デフォルトのforkだとPDFium/PIL/httpxのCコードを実行中の他スレッドが
+    保持するロックを子プロセスが引き継ぎ、デッドロックし得る
+    （ワーカーはモジュールレベル関数なのでspawnで問題なく動く）。
+    spawnは子プロセスの立ち上げが重いため、PDFごとに作り直さず
+    共有の1プールを使い回して起動コストを償却する。
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _render_pool
+
+
+def _discard_render_pool() -> None:
+    """壊れたレンダリングプールを破棄する（次回利用時に再生成される）"""
+    global _render_pool
+    with _render_pool_lock:
+        pool, _render_pool = _render_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _render_pdf_page(pdf_bytes: bytes, page_num: int, max_dimension: int, jpeg_quality: int) -> bytes:
+    """PDFの1ページをJPEGバイト列にレンダリング
+
+    プロセスプールのワーカーとしても呼ばれるためモジュールレベルに置き、
+    ドキュメントハンドルはpickleできないのでワーカーごとにバイト列から
+    開き直します。レンダラはpypdfium2を優先し、無ければPyMuPDFを使います。
+    """
+    with _PDF_RENDER_LOCK:
+        if PYPDFIUM2_AVAILABLE:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                page = pdf[page_num]
+
+                # 最長辺がmax_dimensionになるスケールで画像に変換
+                # （それ以上の解像度はVision側で破棄されるため）
+                width, height = page.get_size()
+                long_side = max(width, height)
+                scale = max_dimension / long_side if long_side else 1.0
+
+                bitmap = page.render(scale=scale)
+                img = bitmap.to_pil()
+                if img.mode != "RGB":
+                    img = img.convert("RGB")
+
+                # JPEG形式でバイトデータに変換
+                # （PNGよりエンコードが軽く、サイズも1/3程度 → Base64コスト削減）
+                buf = io.BytesIO()
+                img.save(buf, "JPEG", quality=jpeg_quality)
+                return buf.getvalue()
+            finally:
+                pdf.close()
+
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            page = doc[page_num]
+            long_side = max(page.rect.width, page.rect.height)
+            zoom = max_dimension / long_side if long_side else 1.0
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            return pix.tobytes("jpeg", jpg_quality=jpeg_quality)
+        finally:
+            doc.close()
+
+
+def _pdf_page_count(pdf_bytes: bytes) -> int:
+    """PDFバイトデータのページ数を取得（利用可能なレンダラで）"""
+    with _PDF_RENDER_LOCK:
+        if PYPDFIUM2_AVAILABLE:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            return len(doc)
+        finally:
+            doc.close()
 
 
 class FileProcessor:
@@ -31,15 +146,37 @@ class FileProcessor:
     SUPPORTED_IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp'}
     SUPPORTED_DOC_EXTENSIONS = {'.pdf'}
 
-    def __init__(self, pdf_dpi: int = 300, pdf_scale: float = 2.0):
+    # 拡張子→メディアタイプの対応
+    # （呼び出しごとに辞書を作り直さないようクラス定数化・interned文字列で照合を高速化）
+    _MEDIA_TYPE_MAP = MappingProxyType({
+        sys.intern(ext): sys.intern(media_type)
+        for ext, media_type in {
+            '.png': 'image/png',
+            '.jpg': 'image/jpeg',
+            '.jpeg': 'image/jpeg',
+            '.gif': 'image/gif',
+            '.webp': 'image/webp',
+            '.bmp': 'image/bmp',
+        }.items()
+    })
+
+    # JPEG変換時の品質（Vision APIの判定に十分でファイルサイズは約1/3）
+    JPEG_QUALITY = 85
+
+    # この画素数を超える非JPEG画像はJPEGに変換してアップロードサイズを削減
+    JPEG_TRANSCODE_PIXEL_THRESHOLD = 2_000_000
+
+    # Vision APIのhighディテール処理が有効な最長辺の上限
+    # （これを超える画素はサーバー側で縮小・破棄されるため送るだけ無駄）
+    VISION_MAX_LONG_SIDE = 2048
+
+    def __init__(self, max_dimension: int = VISION_MAX_LONG_SIDE):
         """初期化
 
         Args:
-            pdf_dpi: PDF変換時のDPI
-            pdf_scale: PDF変換時のスケール倍率
+            max_dimension: 変換後画像の最長辺の上限（ピクセル）
         """
-        self.pdf_dpi = pdf_dpi
-        self.pdf_scale = pdf_scale
+        self.max_dimension = max_dimension
 
     def is_supported(self, file_path: str) -> bool:
         """ファイルが対応形式かどうかを判定"""
@@ -83,8 +220,21 @@ class FileProcessor:
         Returns:
             List of (base64_image, media_type) tuples
         """
-        file_name = uploaded_file.name
-        file_bytes = uploaded_file.read()
+        return self.process_bytes(uploaded_file.read(), uploaded_file.name)
+
+    def process_bytes(self, file_bytes: bytes, file_name: str) -> List[Tuple[str, str]]:
+        """ファイルのバイト列を処理してBase64エンコードされた画像リストを返す
+
+        呼び出し側が既にバイト列を持っている場合のエントリポイント
+        （UploadedFileの再読み込みによる余分なコピーを避けられる）。
+
+        Args:
+            file_bytes: ファイルの内容
+            file_name: 形式判定に使うファイル名
+
+        Returns:
+            List of (base64_image, media_type) tuples
+        """
         ext = Path(file_name).suffix.lower()
 
         if ext in self.SUPPORTED_IMAGE_EXTENSIONS:
@@ -105,25 +255,69 @@ class FileProcessor:
     def _process_image_bytes(self, image_bytes: bytes, ext: str) -> List[Tuple[str, str]]:
         """画像バイトデータを処理"""
         # メディアタイプを決定
-        media_type_map = {
-            '.png': 'image/png',
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.gif': 'image/gif',
-            '.webp': 'image/webp',
-            '.bmp': 'image/bmp'
-        }
-        media_type = media_type_map.get(ext, 'image/png')
+        media_type = self._MEDIA_TYPE_MAP.get(ext, 'image/png')
+
+        # 過大な画像は縮小・JPEG化してアップロードサイズを削減
+        transcoded = self._transcode_to_jpeg(image_bytes, media_type)
+        if transcoded is not None:
+            image_bytes = transcoded
+            media_type = 'image/jpeg'
 
         # Base64エンコード
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
+        # （memoryview経由で余分なコピーを避け、Base64出力はASCII確定なので
+        #   UTF-8バリデーションも省略）
+        base64_image = base64.b64encode(memoryview(image_bytes)).decode('ascii')
 
         return [(base64_image, media_type)]
 
+    def _transcode_to_jpeg(self, image_bytes: bytes, media_type: str) -> Optional[bytes]:
+        """必要に応じて画像を縮小し、JPEGに再エンコード
+
+        - 最長辺がmax_dimensionを超える画像は縮小（Visionが捨てる画素を送らない）
+        - 画素数が閾値を超えるPNG/BMP/GIFはJPEG化
+        どちらにも該当しない画像や読み込めない画像はNoneを返し、
+        元データのまま送信します。透過（アルファ）は白背景に合成します。
+        """
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                needs_resize = max(img.width, img.height) > self.max_dimension
+                needs_jpeg = (
+                    media_type in ('image/png', 'image/bmp', 'image/gif')
+                    and img.width * img.height > self.JPEG_TRANSCODE_PIXEL_THRESHOLD
+                )
+                if not needs_resize and not needs_jpeg:
+                    return None
+
+                if needs_resize:
+                    img.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+
+                # JPEGはアルファ非対応のため白背景に合成
+                if img.mode in ('RGBA', 'LA', 'P'):
+                    img = img.convert('RGBA')
+                    background = Image.new('RGB', img.size, (255, 255, 255))
+                    background.paste(img, mask=img.split()[-1])
+                    img = background
+                elif img.mode != 'RGB':
+                    img = img.convert('RGB')
+
+                buf = io.BytesIO()
+                img.save(buf, 'JPEG', quality=self.JPEG_QUALITY)
+                jpeg_bytes = buf.getvalue()
+
+                # ベタ塗り中心の画像などJPEGの方が大きくなる場合は元データを使う
+                # （縮小した場合は画素数自体が減っているので常に縮小版を採用）
+                if not needs_resize and len(jpeg_bytes) >= len(image_bytes):
+                    return None
+
+                return jpeg_bytes
+        except Exception:
+            # 変換に失敗した場合は元のバイトデータをそのまま使う
+            return None
+
     def _process_pdf(self, file_path: str) -> List[Tuple[str, str]]:
         """PDFファイルを処理"""
-        if not PYMUPDF_AVAILABLE:
-            raise RuntimeError("PyMuPDF is not installed. Cannot process PDF files.")
+        if not PDF_RENDERING_AVAILABLE:
+            raise RuntimeError("Neither pypdfium2 nor PyMuPDF is installed. Cannot process PDF files.")
 
         with open(file_path, "rb") as f:
             pdf_bytes = f.read()
@@ -131,51 +325,58 @@ class FileProcessor:
         return self._process_pdf_bytes(pdf_bytes)
 
     def _process_pdf_bytes(self, pdf_bytes: bytes) -> List[Tuple[str, str]]:
-        """PDFバイトデータを処理"""
-        if not PYMUPDF_AVAILABLE:
-            raise RuntimeError("PyMuPDF is not installed. Cannot process PDF files.")
-
-        results = []
-
-        # PDFを開く
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-
-        try:
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-
-                # 高解像度で画像に変換
-                mat = fitz.Matrix(self.pdf_scale, self.pdf_scale)
-                pix = page.get_pixmap(matrix=mat, alpha=False)
+        """PDFバイトデータを処理
 
-                # PNG形式でバイトデータに変換
-                img_bytes = pix.tobytes("png")
+        レンダリング（ラスタライズ＋JPEGエンコード）はCPUバウンドなため、
+        複数ページのPDFはプロセスプールでページ並列に変換します。
+        """
+        if not PDF_RENDERING_AVAILABLE:
+            raise RuntimeError("Neither pypdfium2 nor PyMuPDF is installed. Cannot process PDF files.")
+
+        # ページ数だけ先に取得（レンダリング自体はワーカー側で行う）
+        page_count = _pdf_page_count(pdf_bytes)
+
+        cpu_count = os.cpu_count() or 1
+        if page_count > 1 and cpu_count > 1:
+            try:
+                executor = _get_render_pool()
+                pages = list(executor.map(
+                    _render_pdf_page,
+                    [pdf_bytes] * page_count,
+                    range(page_count),
+                    [self.max_dimension] * page_count,
+                    [self.JPEG_QUALITY] * page_count,
+                ))
+            except Exception:
+                # プールが壊れた／使えない環境では破棄して逐次レンダリングに
+                # フォールバック（プールは次回利用時に再生成される）
+                _discard_render_pool()
+                pages = None
+        else:
+            pages = None
 
-                # Base64エンコード
-                base64_image = base64.b64encode(img_bytes).decode('utf-8')
+        if pages is None:
+            pages = [
+                _render_pdf_page(pdf_bytes, page_num, self.max_dimension, self.JPEG_QUALITY)
+                for page_num in range(page_count)
+            ]
 
-                results.append((base64_image, "image/png"))
-        finally:
-            doc.close()
-
-        return results
+        return [
+            (base64.b64encode(memoryview(img_bytes)).decode('ascii'), "image/jpeg")
+            for img_bytes in pages
+        ]
 
     def get_pdf_page_count(self, file_path: str) -> int:
         """PDFのページ数を取得"""
-        if not PYMUPDF_AVAILABLE:
-            raise RuntimeError("PyMuPDF is not installed.")
+        if not PDF_RENDERING_AVAILABLE:
+            raise RuntimeError("Neither pypdfium2 nor PyMuPDF is installed.")
 
-        doc = fitz.open(file_path)
-        page_count = len(doc)
-        doc.close()
-        return page_count
+        with open(file_path, "rb") as f:
+            return _pdf_page_count(f.read())
 
     def get_pdf_page_count_from_bytes(self, pdf_bytes: bytes) -> int:
         """PDFバイトデータからページ数を取得"""
-        if not PYMUPDF_AVAILABLE:
-            raise RuntimeError("PyMuPDF is not installed.")
+        if not PDF_RENDERING_AVAILABLE:
+            raise RuntimeError("Neither pypdfium2 nor PyMuPDF is installed.")
 
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        page_count = len(doc)
-        doc.close()
-        return page_count
+        return _pdf_page_count(pdf_bytes)
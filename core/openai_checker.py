@@ -4,49 +4,79 @@ OpenAI GPT-4o Vision ベースのクリエイティブチェッカー
 画像をGPT-4o Visionに送信し、オリコン商標規定に基づいた判定を行います。
 """
 
-import json
+import base64
+import functools
+import hashlib
+import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Any, Optional
-from openai import OpenAI
-
-
-class OpenAICreativeChecker:
-    """OpenAI GPT-4o Visionベースのクリエイティブチェッカー"""
-
-    def __init__(self, api_key: Optional[str] = None):
-        """初期化
 
-        Args:
-            api_key: OpenAI APIキー（省略時は環境変数から取得）
-        """
-        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
-        if not self.api_key:
-            raise ValueError("OpenAI API key is required. Set OPENAI_API_KEY environment variable or pass api_key parameter.")
-
-        self.client = OpenAI(api_key=self.api_key)
-        self.prompt = self._load_prompt()
-
-    def _load_prompt(self) -> str:
-        """プロンプトファイルを読み込む"""
-        # 複数の可能なパスを試行
-        possible_paths = [
-            Path(__file__).parent.parent / "config" / "prompt.txt",
-            Path("config/prompt.txt"),
-            Path("./config/prompt.txt"),
-        ]
-
-        for prompt_path in possible_paths:
-            if prompt_path.exists():
-                with open(prompt_path, "r", encoding="utf-8") as f:
-                    return f.read()
-
-        # デフォルトプロンプト（フォールバック）
-        return self._get_default_prompt()
+import httpx
+import orjson
+from openai import OpenAI
 
-    def _get_default_prompt(self) -> str:
-        """デフォルトプロンプトを返す"""
-        return """
+from .prefilter import LocalPrefilter
+
+logger = logging.getLogger(__name__)
+
+# フォールバック判定用キーワード
+# （複数回のin検索ではなく単一のDFAでレスポンス全体を1パス走査する）
+_LABEL_RE = re.compile(r"問題なし|問題あり|禁止|不合格")
+
+# diskcache (判定結果のキャッシュ用)
+try:
+    import diskcache
+    DISKCACHE_AVAILABLE = True
+except ImportError:
+    DISKCACHE_AVAILABLE = False
+    print("Warning: diskcache not installed. Result caching will be in-memory only.")
+
+
+def _build_http_client() -> httpx.Client:
+    """並列リクエスト向けにチューニングしたHTTPクライアントを生成
+
+    SDKデフォルトのHTTP/1.1クライアントだと、ページ並列のリクエストが
+    コネクション単位で直列化されるため、HTTP/2＋接続プールを指定します。
+    """
+    limits = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+    timeout = httpx.Timeout(60.0, connect=5.0)
+    try:
+        return httpx.Client(http2=True, limits=limits, timeout=timeout)
+    except ImportError:
+        # h2パッケージ未導入の環境ではHTTP/1.1にフォールバック
+        return httpx.Client(limits=limits, timeout=timeout)
+
+
+@functools.cache
+def _load_prompt() -> str:
+    """プロンプトファイルを読み込む（プロセスごとに一度だけ）
+
+    システムプロンプトはOpenAI側のプロンプトキャッシュのキーになるため、
+    全リクエストでバイト単位に同一の文字列を使い回します。
+    （ファイル名などリクエストごとに変わる情報はユーザーメッセージ側に置くこと）
+    """
+    # 複数の可能なパスを試行
+    possible_paths = [
+        Path(__file__).parent.parent / "config" / "prompt.txt",
+        Path("config/prompt.txt"),
+        Path("./config/prompt.txt"),
+    ]
+
+    for prompt_path in possible_paths:
+        if prompt_path.exists():
+            with open(prompt_path, "r", encoding="utf-8") as f:
+                return f.read()
+
+    # デフォルトプロンプト（フォールバック）
+    return _get_default_prompt()
+
+
+def _get_default_prompt() -> str:
+    """デフォルトプロンプトを返す"""
+    return """
 # オリコン顧客満足度調査 クリエイティブチェックAI
 
 この画像を分析し、オリコン顧客満足度(R)調査の表現規定に準拠しているかを検証してください。
@@ -84,12 +114,83 @@ class OpenAICreativeChecker:
 ```
 """
 
+
+class OpenAICreativeChecker:
+    """OpenAI GPT-4o Visionベースのクリエイティブチェッカー"""
+
+    # 同時APIリクエスト数の上限（レート制限対策）
+    MAX_CONCURRENT_REQUESTS = 8
+
+    # 1回のVision呼び出しにまとめるページ数の上限
+    BATCH_SIZE = 6
+
+    # 判定結果キャッシュの保存先
+    CACHE_DIR = Path.home() / ".oricon_cache"
+
+    def __init__(self, api_key: Optional[str] = None):
+        """初期化
+
+        Args:
+            api_key: OpenAI APIキー（省略時は環境変数から取得）
+        """
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        if not self.api_key:
+            raise ValueError("OpenAI API key is required. Set OPENAI_API_KEY environment variable or pass api_key parameter.")
+
+        self.client = OpenAI(
+            api_key=self.api_key,
+            http_client=_build_http_client(),
+            max_retries=2
+        )
+        self.prompt = _load_prompt()
+        self._cache = self._open_cache()
+        self._prefilter = LocalPrefilter()
+
+    def _open_cache(self):
+        """判定結果キャッシュを開く（diskcache未導入時はメモリ辞書）"""
+        if DISKCACHE_AVAILABLE:
+            try:
+                return diskcache.Cache(str(self.CACHE_DIR))
+            except Exception:
+                pass  # キャッシュディレクトリが作れない環境ではメモリにフォールバック
+        return {}
+
+    def _cache_key(self, base64_image: str, detail: str = "high") -> str:
+        """画像内容とプロンプトから決定的なキャッシュキーを生成
+
+        Base64文字列のままだとキーが巨大になるため、
+        生バイトにデコードしてからSHA-256ダイジェストを取ります。
+        detailレベルもキーに含め、low品質の判定がhigh要求に使い回される
+        ことを防ぎます。
+        """
+        try:
+            image_bytes = base64.b64decode(base64_image)
+        except Exception:
+            image_bytes = base64_image.encode("utf-8")
+
+        hasher = hashlib.sha256(image_bytes)
+        hasher.update(self.prompt.encode("utf-8"))
+        hasher.update(b"gpt-4o")
+        hasher.update(detail.encode("ascii"))
+        return hasher.hexdigest()
+
+    @staticmethod
+    def _page_detail(page_num: Optional[int]) -> str:
+        """ページ番号に応じたVisionのdetailレベルを返す
+
+        ランキンググラフィックはほぼ1ページ目にあり、2ページ目以降は
+        規約文などの定型テキストが中心のため、lowに落として
+        入力トークン（highはタイル分割で4〜8倍）を節約します。
+        """
+        return "high" if page_num is None or page_num == 0 else "low"
+
     def check_image(
         self,
         base64_image: str,
         media_type: str,
         file_name: str = "unknown",
-        page_num: Optional[int] = None
+        page_num: Optional[int] = None,
+        detail: str = "high"
     ) -> Dict[str, Any]:
         """画像をチェックして判定結果を返す
 
@@ -98,6 +199,7 @@ class OpenAICreativeChecker:
             media_type: メディアタイプ（例: "image/png"）
             file_name: ファイル名
             page_num: ページ番号（PDFの場合）
+            detail: Visionの解析粒度（"high" / "low"）
 
         Returns:
             判定結果の辞書
@@ -105,7 +207,25 @@ class OpenAICreativeChecker:
         # ページ情報を含むファイル名
         display_name = f"{file_name} (ページ {page_num + 1})" if page_num is not None else file_name
 
+        # 同一画像の再チェックはキャッシュから即座に返す（API課金なし）
+        cache_key = self._cache_key(base64_image, detail)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            result = dict(cached)
+            result["file_name"] = display_name
+            return result
+
+        # 判定が自明な画像はローカルOCRで済ませる（Vision呼び出しを節約）
+        prefilter_result = self._prefilter.check(base64_image)
+        if prefilter_result is not None:
+            result = dict(prefilter_result)
+            result["file_name"] = display_name
+            return result
+
         try:
+            # システムメッセージは全リクエスト共通の固定プレフィックス。
+            # OpenAIのプロンプトキャッシュはプレフィックス一致でヒットするため、
+            # リクエストごとに変わる情報（ファイル名・画像）はユーザー側に置く。
             response = self.client.chat.completions.create(
                 model="gpt-4o",
                 messages=[
@@ -124,20 +244,39 @@ class OpenAICreativeChecker:
                                 "type": "image_url",
                                 "image_url": {
                                     "url": f"data:{media_type};base64,{base64_image}",
-                                    "detail": "high"
+                                    "detail": detail
                                 }
                             }
                         ]
                     }
                 ],
                 max_tokens=2000,
-                temperature=0.1  # 低温度で一貫性のある判定
+                temperature=0.1,  # 低温度で一貫性のある判定
+                response_format={"type": "json_object"}  # JSON出力をAPIレベルで保証
             )
 
+            # プロンプトキャッシュのヒット状況を記録（効果検証用）
+            usage = getattr(response, "usage", None)
+            details = getattr(usage, "prompt_tokens_details", None)
+            if details is not None:
+                logger.debug(
+                    "prompt tokens: %s (cached: %s)",
+                    usage.prompt_tokens,
+                    getattr(details, "cached_tokens", 0),
+                )
+
             # レスポンスからJSONを抽出
             content = response.choices[0].message.content
             result = self._parse_response(content, display_name)
 
+            # 正常に判定できた結果のみキャッシュ
+            # （エラーやJSONパース失敗は再試行できるよう残さない）
+            if result.get("judgment") != "エラー" and "raw_response" not in result:
+                try:
+                    self._cache[cache_key] = result
+                except Exception:
+                    pass  # キャッシュ書き込み失敗は判定結果に影響させない
+
             return result
 
         except Exception as e:
@@ -165,6 +304,9 @@ class OpenAICreativeChecker:
     def _parse_response(self, content: str, file_name: str) -> Dict[str, Any]:
         """APIレスポンスをパースしてJSONに変換
 
+        response_format=json_objectによりレスポンスは素のJSONのはずですが、
+        万一に備えてパース失敗時のフォールバックは残しています。
+
         Args:
             content: APIからのレスポンステキスト
             file_name: ファイル名
@@ -173,38 +315,27 @@ class OpenAICreativeChecker:
             判定結果の辞書
         """
         try:
-            # JSONブロックを抽出
-            if "```json" in content:
-                json_start = content.find("```json") + 7
-                json_end = content.find("```", json_start)
-                json_str = content[json_start:json_end].strip()
-            elif "```" in content:
-                json_start = content.find("```") + 3
-                json_end = content.find("```", json_start)
-                json_str = content[json_start:json_end].strip()
-            else:
-                # JSONブロックがない場合、全体をJSONとして解釈
-                json_str = content.strip()
-
-            result = json.loads(json_str)
+            result = orjson.loads(content)
 
             # ファイル名を上書き（正確性のため）
             result["file_name"] = file_name
 
             return result
 
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             # JSONパースに失敗した場合、テキストから情報を抽出
             return self._create_fallback_result(content, file_name)
 
     def _create_fallback_result(self, content: str, file_name: str) -> Dict[str, Any]:
         """JSONパース失敗時のフォールバック結果を作成"""
-        # 判定を推測
-        judgment = "要確認"
-        if "問題なし" in content:
+        # 判定を推測（テキストを1パスで走査し、出現したラベルで判断）
+        labels = set(_LABEL_RE.findall(content))
+        if "問題なし" in labels:
             judgment = "問題なし"
-        elif "問題あり" in content or "禁止" in content or "不合格" in content:
+        elif labels:
             judgment = "問題あり"
+        else:
+            judgment = "要確認"
 
         return {
             "file_name": file_name,
@@ -235,22 +366,165 @@ class OpenAICreativeChecker:
     ) -> List[Dict[str, Any]]:
         """複数画像（PDFの各ページなど）をチェック
 
+        BATCH_SIZEページずつ1回のVision呼び出しにまとめて
+        API往復回数とシステムプロンプトの送信回数を減らし、
+        バッチ同士はスレッドプールで並列実行します。
+
         Args:
             images: (base64_image, media_type) のタプルのリスト
             file_name: 元のファイル名
 
         Returns:
-            各ページの判定結果リスト
+            各ページの判定結果リスト（ページ順）
         """
-        results = []
+        if not images:
+            return []
 
-        for i, (base64_image, media_type) in enumerate(images):
-            result = self.check_image(
+        if len(images) == 1:
+            base64_image, media_type = images[0]
+            return [self.check_image(
                 base64_image=base64_image,
                 media_type=media_type,
                 file_name=file_name,
-                page_num=i if len(images) > 1 else None
+                page_num=None
+            )]
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(images)
+
+        # キャッシュ・ローカルOCRで判定できるページを先に埋め、
+        # 残りのページだけAPIに回す
+        pending = []
+        for i, (base64_image, media_type) in enumerate(images):
+            cached = self._cache.get(self._cache_key(base64_image, self._page_detail(i)))
+            if cached is None:
+                cached = self._prefilter.check(base64_image)
+            if cached is not None:
+                result = dict(cached)
+                result["file_name"] = f"{file_name} (ページ {i + 1})"
+                results[i] = result
+            else:
+                pending.append(i)
+
+        # 未判定ページをバッチに分割して並列チェック
+        batches = [
+            pending[start:start + self.BATCH_SIZE]
+            for start in range(0, len(pending), self.BATCH_SIZE)
+        ]
+        if batches:
+            max_workers = min(len(batches), self.MAX_CONCURRENT_REQUESTS)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(self._check_image_batch, images, batch, file_name)
+                    for batch in batches
+                ]
+                for batch, future in zip(batches, futures):
+                    for page_num, result in zip(batch, future.result()):
+                        results[page_num] = result
+
+        return results
+
+    def _check_image_batch(
+        self,
+        images: List[tuple],
+        page_nums: List[int],
+        file_name: str
+    ) -> List[Dict[str, Any]]:
+        """複数ページを1回のAPI呼び出しでまとめてチェック
+
+        バッチ判定に失敗した場合（パース不能・件数不一致など）は
+        1ページずつの個別チェックにフォールバックします。
+
+        Args:
+            images: 全ページの (base64_image, media_type) リスト
+            page_nums: このバッチで判定するページ番号（0始まり）
+            file_name: 元のファイル名
+
+        Returns:
+            page_numsと同順の判定結果リスト
+        """
+        if len(page_nums) == 1:
+            i = page_nums[0]
+            base64_image, media_type = images[i]
+            return [self.check_image(
+                base64_image, media_type, file_name,
+                page_num=i, detail=self._page_detail(i)
+            )]
+
+        content: List[Dict[str, Any]] = [
+            {
+                "type": "text",
+                "text": (
+                    f"以下の{len(page_nums)}枚のクリエイティブ画像をそれぞれ分析してください。"
+                    f"ファイル名: {file_name}\n\n"
+                    "必ず {\"results\": [...]} 形式のJSONで出力してください。"
+                    "resultsは画像と同じ順序の配列で、各要素が画像1枚分の判定結果です。"
+                ),
+            }
+        ]
+        for i in page_nums:
+            base64_image, media_type = images[i]
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{media_type};base64,{base64_image}",
+                    # 1ページ目のみhigh（ランキンググラフィック想定）、以降はlow
+                    "detail": self._page_detail(i)
+                }
+            })
+
+        try:
+            response = self.client.chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": self.prompt
+                    },
+                    {
+                        "role": "user",
+                        "content": content
+                    }
+                ],
+                # gpt-4oの出力上限は16384トークン。1ページあたり2000を確保し、
+                # フル6ページバッチでも詳細な指摘リストが切り詰められないようにする
+                max_tokens=min(2000 * len(page_nums), 16000),
+                temperature=0.1,  # 低温度で一貫性のある判定
+                response_format={"type": "json_object"}  # JSON出力をAPIレベルで保証
             )
+
+            # 出力が上限で切り詰められた場合はJSONが壊れている可能性が高いので、
+            # パース事故に任せず明示的にバッチ失敗として扱う
+            if response.choices[0].finish_reason == "length":
+                raise ValueError("Batch response was truncated at the token limit")
+
+            parsed = orjson.loads(response.choices[0].message.content)
+            if isinstance(parsed, dict):
+                parsed = parsed.get("results")
+            if not isinstance(parsed, list) or len(parsed) != len(page_nums):
+                raise ValueError(
+                    f"Expected a JSON array of {len(page_nums)} results, got: {type(parsed).__name__}"
+                )
+            if not all(isinstance(item, dict) and "judgment" in item for item in parsed):
+                raise ValueError("Batch response contains malformed result objects")
+
+        except Exception:
+            # バッチでの一括判定に失敗 → 1ページずつ再チェック
+            return [
+                self.check_image(
+                    images[i][0], images[i][1], file_name,
+                    page_num=i, detail=self._page_detail(i)
+                )
+                for i in page_nums
+            ]
+
+        results = []
+        for page_num, result in zip(page_nums, parsed):
+            result["file_name"] = f"{file_name} (ページ {page_num + 1})"
+            if result.get("judgment") != "エラー":
+                try:
+                    self._cache[self._cache_key(images[page_num][0], self._page_detail(page_num))] = result
+                except Exception:
+                    pass  # キャッシュ書き込み失敗は判定結果に影響させない
             results.append(result)
 
         return results
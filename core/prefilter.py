@@ -0,0 +1,157 @@
+"""ローカル事前チェックモジュール
+
+Vision APIを呼ぶ前に、ローカルOCR（Tesseract）で禁止表現が明確に
+写っているケースだけを先に拾います（問題あり方向のみ）。
+
+「問題なし」はローカルでは出しません。半角スペース区切りやロゴ加工、
+ランキング名の妥当性はOCRでは検証できないため、合格判定を返すと
+規定違反を見逃す（コンプライアンスチェッカーとして最悪の誤り）
+リスクがあります。禁止表現が見つからなければNoneを返し、
+判定全体をGPT-4o Visionに委ねます。
+"""
+
+import base64
+import hashlib
+import io
+import re
+from typing import Dict, Any, Optional
+
+from PIL import Image
+
+# pytesseract (ローカルOCR用・Tesseract本体が別途必要)
+try:
+    import pytesseract
+    PYTESSERACT_AVAILABLE = True
+except ImportError:
+    PYTESSERACT_AVAILABLE = False
+
+# 禁止表現（1つでも写っていれば即「問題あり」にできる）
+_PROHIBITED_RE = re.compile(
+    r"オリコンランキング"
+    r"|オリコン第?[0-9０-９]+位"
+    r"|オリコンNo\.?1"
+    r"|オリコンナンバーワン"
+)
+
+# 必須要素（検出結果の参考情報としてNG結果に添えるのみ・合格判定には使わない）
+_YEAR_RE = re.compile(r"20[0-9０-９]{2}年?")
+_ISSUER_RE = re.compile(r"オリコン顧客満足度\s*(?:[\(（]R[\)）]|®)")
+_POSITION_RE = re.compile(r"第[0-9０-９]+位|優秀企業|高評企業|推奨意向")
+
+
+class LocalPrefilter:
+    """OCRベースの事前チェッカー
+
+    判定できたときは check_image と同じ形式の結果辞書を返し、
+    判定を保留するとき（OCR不可・要素不足・曖昧）はNoneを返します。
+    """
+
+    # OCRにかける前の縮小サイズ（精度と速度のバランス）
+    OCR_THUMBNAIL_SIZE = 512
+
+    # 判定メモの上限（同一画像の再OCRを避けるための小さなキャッシュ）
+    MEMO_MAX_ENTRIES = 128
+
+    def __init__(self):
+        self.available = PYTESSERACT_AVAILABLE and self._tesseract_usable()
+        self._memo: Dict[str, Optional[Dict[str, Any]]] = {}
+
+    @staticmethod
+    def _tesseract_usable() -> bool:
+        """Tesseract本体と日本語データが使えるかを確認"""
+        try:
+            return "jpn" in pytesseract.get_languages(config="")
+        except Exception:
+            return False
+
+    def check(self, base64_image: str) -> Optional[Dict[str, Any]]:
+        """画像を事前チェック
+
+        Args:
+            base64_image: Base64エンコードされた画像データ
+
+        Returns:
+            判定が自明な場合は結果辞書、それ以外はNone
+        """
+        if not self.available:
+            return None
+
+        # 同一画像の再OCRを避ける（チェッカー側の複数経路から呼ばれるため）
+        memo_key = hashlib.sha256(base64_image.encode("ascii", "ignore")).hexdigest()
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+
+        result = self._check_uncached(base64_image)
+        if len(self._memo) >= self.MEMO_MAX_ENTRIES:
+            self._memo.clear()
+        self._memo[memo_key] = result
+        return result
+
+    def _check_uncached(self, base64_image: str) -> Optional[Dict[str, Any]]:
+        """OCRを実行して判定（メモを介さない実体）"""
+        text = self._ocr(base64_image)
+        if text is None:
+            return None
+
+        # 禁止表現の検出は確度が高い（部分一致でも規定違反）
+        prohibited = _PROHIBITED_RE.search(text)
+        if prohibited:
+            return self._build_result(
+                judgment="問題あり",
+                issues=[{
+                    "severity": "critical",
+                    "category": "禁止表現",
+                    "description": f"禁止表現「{prohibited.group(0)}」が検出されました。"
+                }],
+                detected=self._detect_elements(text),
+                notes="ローカルOCRによる自動判定です。"
+            )
+
+        # 「問題なし」はローカルでは出さない。ランキング名・半角スペース
+        # 区切り・ロゴ加工はOCRでは検証できず、合格の誤判定（見逃し）は
+        # このチェッカーで最悪の誤りになるため、Visionに委ねる。
+        return None
+
+    def _ocr(self, base64_image: str) -> Optional[str]:
+        """縮小画像に対してOCRを実行（失敗時はNone）"""
+        try:
+            image_bytes = base64.b64decode(base64_image)
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                img.thumbnail((self.OCR_THUMBNAIL_SIZE, self.OCR_THUMBNAIL_SIZE), Image.LANCZOS)
+                if img.mode != "RGB":
+                    img = img.convert("RGB")
+                return pytesseract.image_to_string(img, lang="jpn")
+        except Exception:
+            return None
+
+    @staticmethod
+    def _detect_elements(text: str) -> Dict[str, Any]:
+        """OCRテキストから必須要素を抽出"""
+        year = _YEAR_RE.search(text)
+        issuer = _ISSUER_RE.search(text)
+        position = _POSITION_RE.search(text)
+        return {
+            "year": year.group(0) if year else None,
+            "issuer": issuer.group(0) if issuer else None,
+            "ranking_name": None,  # 業種名はOCRの語彙では判定できない
+            "position": position.group(0) if position else None,
+            "trademark_symbol": issuer is not None
+        }
+
+    @staticmethod
+    def _build_result(
+        judgment: str,
+        issues: list,
+        detected: Dict[str, Any],
+        notes: str
+    ) -> Dict[str, Any]:
+        """check_imageと同じ形式の結果辞書を組み立てる"""
+        return {
+            "file_name": "unknown",
+            "company_name": "不明",
+            "judgment": judgment,
+            "issues": issues,
+            "detected_elements": detected,
+            "notes": notes,
+            "source": "local_prefilter"
+        }